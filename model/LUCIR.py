@@ -55,8 +55,9 @@ class LUCIR(nn.Module, ContinualLearningModel):
             # copy the weight of previous weight vector
             previous_weight_vectors = self.weight_vectors[-1]
 
-            self.current_weight_vectors.data[:len(
-                self.learned_classes)] = previous_weight_vectors.data[:, :]
+            with torch.no_grad():
+                self.current_weight_vectors[:len(
+                    self.learned_classes)].copy_(previous_weight_vectors)
 
         self.current_weight_vectors = nn.Parameter(self.current_weight_vectors)
 
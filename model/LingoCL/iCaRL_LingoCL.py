@@ -1,5 +1,4 @@
 # Standard Library
-import copy
 from contextlib import contextmanager
 
 # Third-Party Library
@@ -7,7 +6,7 @@ import clip
 
 # Torch Library
 import torch
-import torch.nn as nn
+import torch.nn.functional as F
 import torchvision.models as models
 
 # My Library
@@ -27,20 +26,10 @@ class iCaRL_LingoCL(iCaRL):
         num_cls = len(task)
         self.current_task = task
 
-        # before the start learning the task, expand the weight vectors
-
-        # create new weight vectors
-        self.current_weight_vectors = nn.Linear(
-            in_features=self.feature_dim, out_features=num_cls + len(self.learned_classes), bias=False).to(device=self.feature_extractor.conv1.weight.device)
-
-        # for the second task, copy the weights of last weight vectors
-        if len(self.weight_vectors) > 0:
-
-            # copy the weight of previous weight vector
-            previous_weight_vector = self.weight_vectors[-1]
-
-            self.current_weight_vectors.weight.data[:len(
-                self.learned_classes), :] = previous_weight_vector.weight.data[:, :]
+        # before the start learning the task, expand the weight vectors, weights of learned classes are kept
+        num_learned = len(self.learned_classes)
+        self._num_seen = num_learned + num_cls
+        assert self._num_seen <= self.max_classes, f"iCaRL supports at most {self.max_classes} classes"
 
         # use clip to generate weights for new classes
         text = clip.tokenize([f"a {i}" for i in task]).to(
@@ -55,33 +44,28 @@ class iCaRL_LingoCL(iCaRL):
         # Ref: Page 3, Section 3.2 Our Proposed Language-Guided Supervision, (ii)
         weights = text_features
 
-        self.current_weight_vectors.weight.data[len(
-            self.learned_classes):] = weights
+        with torch.no_grad():
+            self._head_weight[num_learned:self._num_seen].copy_(weights)
 
         # freeze the weight vector
-        for param in self.current_weight_vectors.parameters():
-            param.requires_grad = False
+        self._head_weight.requires_grad_(False)
 
         # return to task learning
         yield self
 
         # after the task, save the feature extractor and weight vectors
 
-        # switch the current weight vectors to evaluation mode
-        self.current_weight_vectors.eval()
-
         # save the current weight vectors
-        self.weight_vectors.append(self.current_weight_vectors)
+        with torch.no_grad():
+            self._previous_head_weight[:self._num_seen].copy_(
+                self._head_weight[:self._num_seen])
 
         # copy the last feature extractor
-        self.previous_feature_extractor = copy.deepcopy(
-            self.feature_extractor)
-
-        # freeze previous feature extractor and switch to evaluation mode
-        for param in self.previous_feature_extractor.parameters():
-            param.requires_grad = False
+        self.previous_feature_extractor.load_state_dict(
+            self.feature_extractor.state_dict())
 
-        self.previous_feature_extractor.eval()
+        # make sure the previous feature extractor stays frozen, i.e., no gradient and no update of BatchNorm running stats
+        self.previous_feature_extractor.requires_grad_(False).eval()
 
         # expand the learned classes
         self.learned_classes.extend(task)
@@ -101,7 +85,7 @@ class iCaRL_LingoCL(iCaRL):
         features = self.feature_extractor(image)
 
         features = features / features.norm(dim=1, keepdim=True)
-        logits = self.current_weight_vectors(features)
+        logits = F.linear(features, self.get_weight_vectors())
 
         return logits
 
@@ -120,7 +104,7 @@ if __name__ == "__main__":
             print(logits.shape)
 
         for cls_name in task:
-            lingo.exemplar_means[cls_name] = torch.randn(1, 512)
+            lingo.set_exemplar_mean(cls_name, torch.randn(1, 512))
 
         preds = lingo.get_preds(image)
         print(preds)
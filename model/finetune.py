@@ -40,8 +40,9 @@ class Finetune(nn.Module, ContinualLearningModel):
         if len(self.classifiers) != 0:
             previous_classifier = self.classifiers[-1]
 
-            self.current_classifier.weight.data[:len(
-                self.learned_classes), :] = previous_classifier.weight.data[:, :]
+            with torch.no_grad():
+                self.current_classifier.weight[:len(
+                    self.learned_classes)].copy_(previous_classifier.weight)
 
         self.classifiers.append(self.current_classifier)
 
@@ -1,5 +1,5 @@
 # Standard Library
-import copy
+import math
 from typing import Optional
 from contextlib import contextmanager
 
@@ -8,6 +8,7 @@ from contextlib import contextmanager
 # Torch Library
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torchvision.models as models
 from torchvision.models.resnet import ResNet
 
@@ -16,105 +17,224 @@ from utils.annotation import Task
 from .base import ContinualLearningModel
 
 
+@torch.jit.script
+def nmc_predict(features: torch.Tensor, means: torch.Tensor) -> torch.Tensor:
+    """
+    Nearest-Mean-of-Exemplars classification, scripted to fuse the normalization and distance computation.
+
+    Args:
+        features (torch.Tensor): features of images, shape [B, D]
+        means (torch.Tensor): means of exemplar sets, shape [N, D]
+    Returns:
+        torch.Tensor: predictions, shape [B]
+    """
+    # Note: iCaRL L2-normalizes the features
+    # ref: Page 2, Architecture, Paragraph 1, Line 5: "All feature vectors are L2-normalized..."
+    features = features / features.norm(p=2, dim=1, keepdim=True)
+
+    # Note: cdist computes the pairwise distances with a matmul, instead of materializing a [B, N, D] tensor
+    # [B, N]
+    return torch.cdist(features, means, p=2.0).argmin(dim=1)
+
+
 class iCaRL(nn.Module, ContinualLearningModel):
 
-    def __init__(self, feature_dim: int = 512) -> None:
-        super().__init__()
-        self.feature_extractor: ResNet = models.resnet34(
-            weights=models.ResNet34_Weights.DEFAULT)
+    @staticmethod
+    def get_feature_extractor(feature_dim: int, weights: Optional[models.ResNet34_Weights] = None) -> ResNet:
+        feature_extractor: ResNet = models.resnet34(weights=weights)
 
         # Note: when input batched image is [1, C, H, W], resnet will be wrong for Resnet._forward_impl.layer4(x)
         # Note: this is because the maxpool layer. So, remove the maxpool
         # Note: check module/resnet.py for my implementation
-        self.feature_extractor.maxpool = nn.Identity()
+        feature_extractor.maxpool = nn.Identity()
 
         # map the features from feature space into prototype space
-        self.feature_extractor.fc = nn.Sequential(
-            nn.Linear(self.feature_extractor.fc.in_features, feature_dim),
+        feature_extractor.fc = nn.Sequential(
+            nn.Linear(feature_extractor.fc.in_features, feature_dim),
         )
 
+        return feature_extractor
+
+    def __init__(self, feature_dim: int = 512, max_classes: int = 100) -> None:
+        super().__init__()
+        self.feature_extractor: ResNet = self.get_feature_extractor(
+            feature_dim, weights=models.ResNet34_Weights.DEFAULT)
+
         self.feature_dim = feature_dim
 
         # after learning the current task, the mean of exemplar sets need to be recalculated, so we need to save the current feature extractor
-        self.previous_feature_extractor: ResNet = None
+        # Note: the previous feature extractor is pre-allocated and frozen, so saving the current feature extractor only copies the weights via state_dict
+        self.previous_feature_extractor: ResNet = self.get_feature_extractor(
+            feature_dim, weights=None)
+        self.previous_feature_extractor.requires_grad_(False).eval()
 
         # Note: iCaRL uses weight vectors for representation learning, not classification
         # Ref: Page 3, Architecture, Paragraph 2, Line 11: "Note that even though one can interpret these outputs as probabilities, iCaRL uses the network only for representation learning, not for the actual classification step."
-        self.weight_vectors: list[nn.Linear] = []
-        self.current_weight_vectors: nn.Linear = None
+        # Note: weight vectors of all classes are pre-allocated as a single parameter, only the first _num_seen rows are used
+        # Note: weight vectors of the previous model are saved in _previous_head_weight, i.e., the first len(learned_classes) rows
+        self.max_classes = max_classes
+        self._head_weight = nn.Parameter(torch.zeros(max_classes, feature_dim))
+        self.register_buffer("_previous_head_weight",
+                             torch.zeros(max_classes, feature_dim))
+        self._num_seen: int = 0
+        self._use_previous_head: bool = False
 
         # Note: iCaRL uses Nearest-Mean-of-Exemplars to classify a given example
+        # Note: exemplar_means should be updated through set_exemplar_mean, so that the stacked means matrix can be cached
         self.exemplar_means: dict[str, torch.FloatTensor] = {}
+        self._means_matrix: Optional[torch.FloatTensor] = None
+        self._means_dirty: bool = True
+
+        # Note: for latent replay, the backbone features (input of feature_extractor.fc) of exemplars are computed once and
+        # Note: replayed through feature_extractor.fc and weight vectors only, so the convolutions are skipped for exemplars
+        self.exemplar_features: dict[str, torch.FloatTensor] = {}
 
         self.current_task: Task = None
         self.learned_classes: list[str] = []
 
+        # Note: channels_last matches the NHWC convolution kernels of cuDNN, which use tensor cores under mixed precision
+        self.to(memory_format=torch.channels_last)
+
     @contextmanager
     def set_new_task(self, task: Task):
         num_cls = len(task)
         self.current_task = task
 
         # before the start learning the task, expand the weight vectors
+        num_learned = len(self.learned_classes)
+        self._num_seen = num_learned + num_cls
+        assert self._num_seen <= self.max_classes, f"iCaRL supports at most {self.max_classes} classes"
 
-        # create new weight vectors
-        self.current_weight_vectors = nn.Linear(
-            in_features=self.feature_dim, out_features=num_cls + len(self.learned_classes), bias=False).to(device=self.feature_extractor.conv1.weight.device)
-
-        # for the second task, copy the weights of last weight vectors
-        if len(self.weight_vectors) > 0:
-
-            # copy the weight of previous weight vector
-            previous_weight_vector = self.weight_vectors[-1]
-
-            self.current_weight_vectors.weight.data[:len(
-                self.learned_classes), :] = previous_weight_vector.weight.data[:, :]
+        # initialize the weight vectors of new classes as nn.Linear does, weights of learned classes are kept
+        with torch.no_grad():
+            nn.init.kaiming_uniform_(
+                self._head_weight[num_learned:self._num_seen], a=math.sqrt(5))
 
         # return to task learning
         yield self
 
         # after the task, save the feature extractor and weight vectors
 
-        # freeze the current weight vector and switch to evaluation mode
-        for param in self.current_weight_vectors.parameters():
-            param.requires_grad = False
-
-        self.current_weight_vectors.eval()
-
         # save the current weight vectors
-        self.weight_vectors.append(self.current_weight_vectors)
+        with torch.no_grad():
+            self._previous_head_weight[:self._num_seen].copy_(
+                self._head_weight[:self._num_seen])
 
         # copy the last feature extractor
-        self.previous_feature_extractor = copy.deepcopy(
-            self.feature_extractor)
+        self.previous_feature_extractor.load_state_dict(
+            self.feature_extractor.state_dict())
 
-        # freeze previous feature extractor and switch to evaluation mode
-        for param in self.previous_feature_extractor.parameters():
-            param.requires_grad = False
-
-        self.previous_feature_extractor.eval()
+        # make sure the previous feature extractor stays frozen, i.e., no gradient and no update of BatchNorm running stats
+        self.previous_feature_extractor.requires_grad_(False).eval()
 
         # expand the learned classes
         self.learned_classes.extend(task)
 
     @contextmanager
-    def use_previous_model(self, feature_extractor: Optional[ResNet] = None, weight_vectors: Optional[nn.Linear] = None):
+    def use_previous_model(self, feature_extractor: Optional[ResNet] = None):
         current_feature_extractor = self.feature_extractor
-        current_weight_vectors = self.current_weight_vectors
 
         try:
             self.feature_extractor = feature_extractor if feature_extractor is not None else self.previous_feature_extractor
-            self.current_weight_vectors = weight_vectors if weight_vectors is not None else self.weight_vectors[-1]
-            yield self
+            self._use_previous_head = True
+
+            # Note: previous model is only used as teacher, inference_mode skips saving activations for autograd
+            with torch.inference_mode():
+                yield self
         finally:
             self.feature_extractor = current_feature_extractor
-            self.current_weight_vectors = current_weight_vectors
+            self._use_previous_head = False
+
+    def get_weight_vectors(self) -> torch.FloatTensor:
+        """
+        Returns:
+            torch.FloatTensor: weight vectors of the current model, shape [N, D], or of the previous model in use_previous_model
+        """
+        if self._use_previous_head:
+            return self._previous_head_weight[:len(self.learned_classes)]
+        return self._head_weight[:self._num_seen]
+
+    def train(self, mode: bool = True) -> "iCaRL":
+        super().train(mode)
+
+        # Note: previous feature extractor is frozen, so keep it in evaluation mode to not update the BatchNorm running stats
+        self.previous_feature_extractor.eval()
+        return self
+
+    def set_exemplar_mean(self, cls_name: str, mean: torch.FloatTensor) -> None:
+        """
+        Args:
+            cls_name (str): name of the class
+            mean (torch.FloatTensor): mean of the exemplar set of the class, shape [1, D]
+        """
+        self.exemplar_means[cls_name] = mean
+        self._means_dirty = True
 
-    def forward(self, image: torch.FloatTensor) -> torch.FloatTensor:
+    def set_exemplar_means(self, cls_names: list[str], means: torch.FloatTensor) -> None:
+        """
+        Args:
+            cls_names (list[str]): name of the classes
+            means (torch.FloatTensor): means of the exemplar sets of the classes, shape [N, D]
+        """
+        for cls_name, mean in zip(cls_names, means):
+            self.exemplar_means[cls_name] = mean.unsqueeze(dim=0)
+
+        # if all the classes are given in order, the means can be used as the stacked means matrix directly
+        if list(self.exemplar_means.keys()) == list(cls_names):
+            self._means_matrix = means
+            self._means_dirty = False
+        else:
+            self._means_dirty = True
+
+    def get_means_matrix(self) -> torch.FloatTensor:
+        """
+        Returns:
+            torch.FloatTensor: stacked exemplar means, shape [N, D], rebuilt only when exemplar means are changed
+        """
+        if self._means_dirty or self._means_matrix is None:
+            self._means_matrix = torch.cat(
+                list(self.exemplar_means.values()), dim=0)
+            self._means_dirty = False
+        return self._means_matrix
+
+    def set_exemplar_features(self, cls_name: str, features: torch.FloatTensor) -> None:
+        """
+        Args:
+            cls_name (str): name of the class
+            features (torch.FloatTensor): backbone features of the exemplar set of the class, shape [M, 512]
+        """
+        self.exemplar_features[cls_name] = features
+
+    @torch.no_grad()
+    def get_backbone_features(self, image: torch.FloatTensor) -> torch.FloatTensor:
         """
         Args:
             image (torch.FloatTensor): input image, shape [B, C, H, W]
         Returns:
-            torch.FloatTensor: output logits, shape [B, N] (N for number of classes learned so far)
+            torch.FloatTensor: backbone features, i.e., the input of feature_extractor.fc, shape [B, 512]
+        """
+        fe = self.feature_extractor
+
+        x = fe.maxpool(fe.relu(fe.bn1(fe.conv1(image))))
+        x = fe.layer4(fe.layer3(fe.layer2(fe.layer1(x))))
+        return torch.flatten(fe.avgpool(x), 1)
+
+    def forward_from_features(self, features: torch.FloatTensor) -> torch.FloatTensor:
+        """
+        Args:
+            features (torch.FloatTensor): backbone features, shape [R, 512]
+        Returns:
+            torch.FloatTensor: output logits, shape [R, N] (N for number of classes learned so far)
+        """
+        return F.linear(self.feature_extractor.fc(features), self.get_weight_vectors())
+
+    def forward(self, image: torch.FloatTensor, replay_features: Optional[torch.FloatTensor] = None) -> torch.FloatTensor:
+        """
+        Args:
+            image (torch.FloatTensor): input image, shape [B, C, H, W]
+            replay_features (Optional[torch.FloatTensor]): backbone features of replayed exemplars, shape [R, 512]
+        Returns:
+            torch.FloatTensor: output logits, shape [B, N] or [B + R, N] if replay_features is given (N for number of classes learned so far)
         """
 
         # sourcery skip: inline-immediately-returned-variable
@@ -123,7 +243,12 @@ class iCaRL(nn.Module, ContinualLearningModel):
 
         features = self.feature_extractor(image)
 
-        logits = self.current_weight_vectors(features)
+        logits = F.linear(features, self.get_weight_vectors())
+
+        # Note: replay in the same forward, so that DistributedDataParallel sees a single forward per backward
+        if replay_features is not None:
+            logits = torch.cat(
+                (logits, self.forward_from_features(replay_features)), dim=0)
 
         return logits
 
@@ -140,22 +265,10 @@ class iCaRL(nn.Module, ContinualLearningModel):
         # [B, 512]
         features = self.feature_extractor(image)
 
-        # Note: iCaRL L2-normalizes the features
-        # ref: Page 2, Architecture, Paragraph 1, Line 5: "All feature vectors are L2-normalized..."
-        features = features / features.norm(p=2, dim=1, keepdim=True)
-
-        # [B, 1, 512]
-        features = features.unsqueeze(dim=1)
-
-        # [1, N, 512]
-        cls_means: torch.FloatTensor = torch.cat(
-            list(self.exemplar_means.values()), dim=0).unsqueeze(dim=0)
+        # [N, 512]
+        cls_means: torch.FloatTensor = self.get_means_matrix()
 
-        # [B, N, 512]
-        pred = features - cls_means
-        # [B, N]
-        pred = pred.norm(p=2, dim=2, keepdim=False)
-        return pred.argmin(dim=1)
+        return nmc_predict(features, cls_means)
 
 
 if __name__ == "__main__":
@@ -173,7 +286,7 @@ if __name__ == "__main__":
 
         # calculate mean of class
         for i, t_name in enumerate(t):
-            model.exemplar_means[t_name] = (
-                torch.ones(1, 512) * i).to("cuda:0")
+            model.set_exemplar_mean(t_name, (
+                torch.ones(1, 512) * i).to("cuda:0"))
 
         pred = model.get_preds(test_image)
@@ -9,6 +9,7 @@ import numpy as np
 # Torch Library
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.optim as optim
 import torch.optim.lr_scheduler
 from torch.utils.data import DataLoader
@@ -21,10 +22,9 @@ from utils.helper import get_logger
 from utils.datasets import (get_dataset,
                             get_cls_data_getter,
                             CLDatasetGetter)
-from utils.transforms import get_transforms
 from utils.data.cifar100 import Cifar100Dataset
 from utils.helper import (plot_matrix, draw_image)
-from utils.helper import (get_probas, get_pred, to_khot)
+from utils.helper import (to_khot)
 from utils.helper import (get_top1_acc,
                           get_backward_transfer,
                           get_last_setp_accuracy,
@@ -47,11 +47,8 @@ device = torch.device("cuda:1")
 hparams_dict = {}
 
 
-crop_size = 32
-
-
 def train_epoch(model: iCaRL_LingoCL, train_loader: DataLoader, loss_func: nn.Module, optimizer: optim.Optimizer) -> float:
-    total_loss = 0
+    total_loss = torch.zeros((), device=device)
 
     sigmoid = nn.Sigmoid()
     distill_loss_func = nn.BCELoss(reduction="mean")
@@ -63,8 +60,8 @@ def train_epoch(model: iCaRL_LingoCL, train_loader: DataLoader, loss_func: nn.Mo
     image: torch.FloatTensor
     label: torch.LongTensor
     for image, label in train_loader:
-        image = image.to(device)
-        label = to_khot(label, total_num_classes).to(device)
+        image = train_loader.dataset.augment(image.to(device, non_blocking=True))
+        label = to_khot(label.to(device, non_blocking=True), total_num_classes)
 
         # for new classes, use cross entropy loss
         logits = model(image)
@@ -98,13 +95,13 @@ def train_epoch(model: iCaRL_LingoCL, train_loader: DataLoader, loss_func: nn.Mo
 
         loss = classification_loss + distillation_loss
 
-        total_loss += loss.clone().detach()
+        total_loss.add_(loss.detach())
 
         optimizer.zero_grad()
         loss.backward()
         optimizer.step()
 
-    return total_loss / len(train_loader)
+    return (total_loss / len(train_loader)).item()
 
 
 def paper_train_epoch(model: iCaRL_LingoCL, train_loader: DataLoader, loss_func: nn.Module, optimizer: optim.Optimizer) -> float:
@@ -116,7 +113,7 @@ def paper_train_epoch(model: iCaRL_LingoCL, train_loader: DataLoader, loss_func:
     After the training, new classes exemplar is generated using the model and is used to classify. So, since the CrossEntropy loss gets a
     better feature extractor, the above training code gets better results on all classes.
     """
-    total_loss = 0
+    total_loss = torch.zeros((), device=device)
 
     sigmoid = nn.Sigmoid()
     loss_func = nn.BCELoss(reduction="mean")
@@ -127,8 +124,8 @@ def paper_train_epoch(model: iCaRL_LingoCL, train_loader: DataLoader, loss_func:
     image: torch.FloatTensor
     label: torch.LongTensor
     for image, label in train_loader:
-        image = image.to(device)
-        label = to_khot(label, total_num_classes).to(device)
+        image = train_loader.dataset.augment(image.to(device, non_blocking=True))
+        label = to_khot(label.to(device, non_blocking=True), total_num_classes)
 
         # get the logits of current model
         logits = model(image)
@@ -158,23 +155,25 @@ def paper_train_epoch(model: iCaRL_LingoCL, train_loader: DataLoader, loss_func:
         loss.backward()
         optimizer.step()
 
-        total_loss += loss.clone().detach()
+        total_loss.add_(loss.detach())
 
-    return total_loss / len(train_loader)
+    return (total_loss / len(train_loader)).item()
 
 
 @torch.no_grad()
-def test_epoch(model: iCaRL_LingoCL, test_loader: DataLoader, perf_func: PerformanceFunc, num_cls_per_task: int) -> tuple[torch.FloatTensor, torch.FloatTensor]:
-    performance = []
+def test_epoch(model: iCaRL_LingoCL, test_loader: DataLoader, perf_func: PerformanceFunc, num_cls_per_task: int) -> float:
+    performance = torch.zeros((), device=device)
+    num_batches = 0
 
     # Note: iCaRL use Nearest-Mean-of-Exemplars to classify, here using output logits just for monitor the learning
     for image, label in test_loader:
-        image, label = image.to(device), label.to(device)
-        preds = get_pred(get_probas(model(image)))
-        performance.append(
+        image, label = test_loader.dataset.augment(image.to(device, non_blocking=True)), label.to(device, non_blocking=True)
+        preds = model(image).argmax(dim=1)
+        performance.add_(
             perf_func(preds, label, len(model.learned_classes) + num_cls_per_task))
+        num_batches += 1
 
-    return sum(performance) / len(performance)
+    return (performance / num_batches).item()
 
 
 @torch.no_grad()
@@ -184,7 +183,7 @@ def calculate_cls_features(cls_data_loader: DataLoader, model: iCaRL_LingoCL) ->
     image: torch.FloatTensor
     features: torch.FloatTensor
     for image, _ in cls_data_loader:
-        image = image.to(device)
+        image = cls_data_loader.dataset.augment(image.to(device, non_blocking=True))
         features = model.feature_extractor(image)
         features = features / features.norm(p=2, dim=1, keepdim=True)
         cls_features.append(features)
@@ -193,21 +192,37 @@ def calculate_cls_features(cls_data_loader: DataLoader, model: iCaRL_LingoCL) ->
 
 
 @torch.no_grad()
-def calculate_exemplar_mean(dataset: SupportedDataset, exemplar_image: Images, exemplar_label: Labels, model: iCaRL_LingoCL) -> torch.FloatTensor:
+def calculate_exemplar_means(dataset: SupportedDataset, exemplar_set: dict[str, tuple[Images, Labels]], model: iCaRL_LingoCL) -> torch.FloatTensor:
     # use test transforms here, for the predictions is made on test images
-    _, transforms = get_transforms(
-        dataset=dataset, crop_size=crop_size, same_crop=False)
+    _, transforms = get_dataset(dataset).get_transforms()
+
+    # Note: the features of all exemplar sets are calculated in one pass, and averaged per class with a single matmul
+    exemplar_image = np.concatenate(
+        [image for image, _ in exemplar_set.values()], axis=0)
+    exemplar_label = np.concatenate(
+        [label for _, label in exemplar_set.values()], axis=0)
 
     exemplar_dataset = get_dataset(dataset)(
         exemplar_image, exemplar_label, transforms)
 
     exemplar_loader = DataLoader(
-        exemplar_dataset, batch_size=32, shuffle=False, num_workers=2)
+        exemplar_dataset, batch_size=32, shuffle=False, num_workers=2, pin_memory=True)
 
-    # [N, 512]
-    cls_features = calculate_cls_features(exemplar_loader, model)
+    # [N_ex, 512]
+    exemplar_features = calculate_cls_features(exemplar_loader, model)
 
-    return cls_features.mean(dim=0, keepdim=True)
+    # [N_ex], the position of the class of each exemplar in exemplar_set
+    exemplar_position = torch.repeat_interleave(
+        torch.arange(len(exemplar_set), device=device),
+        torch.tensor([len(label) for _, label in exemplar_set.values()], device=device))
+
+    # [N_cls, N_ex], row-normalized class-assignment matrix
+    assignment = F.one_hot(exemplar_position, num_classes=len(
+        exemplar_set)).T.to(exemplar_features.dtype)
+    assignment = assignment / assignment.sum(dim=1, keepdim=True)
+
+    # [N_cls, 512]
+    return assignment @ exemplar_features
 
 
 @torch.no_grad()
@@ -217,13 +232,12 @@ def build_exemplar_set(dataset: SupportedDataset, cls_name: str, cls_id: int, ex
     cls_images, cls_labels = cls_data_getter(cls_name, cls_id)
 
     # use test transforms here, for the predictions is made on test images
-    _, transforms = get_transforms(
-        dataset=dataset, crop_size=crop_size, same_crop=False)
+    _, transforms = get_dataset(dataset).get_transforms()
 
     cls_data_dataset = get_dataset(dataset)(cls_images, cls_labels, transforms)
 
     cls_data_loader = DataLoader(
-        cls_data_dataset, batch_size=32, shuffle=False, num_workers=2)
+        cls_data_dataset, batch_size=32, shuffle=False, num_workers=2, pin_memory=True)
 
     # get features
     # [N, 512]
@@ -352,18 +366,20 @@ def get_continual_learning_ability_tester(task_num: int, num_cls_per_task: int)
         for i, previous_loader in enumerate(learned_task_loaders):
 
             # iCaRL use Nearest-Mean-of-Exemplar to classify, so use that here
-            performance = []
+            performance = torch.zeros((), device=device)
+            num_batches = 0
 
             image: torch.FloatTensor
             label: torch.FloatTensor
             for image, label in previous_loader:
-                image, label = image.to(device), label.to(device)
+                image, label = previous_loader.dataset.augment(image.to(device, non_blocking=True)), label.to(device, non_blocking=True)
                 preds = model.get_preds(image)
-                performance.append(
+                performance.add_(
                     get_top1_acc(preds, label, len(model.learned_classes))
                 )
+                num_batches += 1
 
-            cl_matrix[i, task_id] = sum(performance) / len(performance)
+            cl_matrix[i, task_id] = (performance / num_batches).item()
 
             logger.info(
                 f"\ttest on task {i}, test_acc={cl_matrix[i, task_id]: .2f}, {learned_tasks[i]}")
@@ -430,18 +446,13 @@ def continual_learning():
         exemplar_images: Images
         exemplar_labels: Labels
         for exemplar_images, exemplar_labels in exemplar_set.values():
-            current_task_images: Images = train_dataset.images
-            current_task_labels: Labels = train_dataset.labels
-            train_dataset.images = np.concatenate(
-                (current_task_images, exemplar_images), axis=0)
-            train_dataset.labels = np.concatenate(
-                (current_task_labels, exemplar_labels), axis=0)
+            train_dataset.append(exemplar_images, exemplar_labels)
 
         # get dataloader
         train_loader = DataLoader(
-            train_dataset, batch_size=32, shuffle=True, num_workers=2)
+            train_dataset, batch_size=32, shuffle=True, num_workers=4, pin_memory=True, persistent_workers=True, prefetch_factor=4)
         test_loader = DataLoader(
-            test_dataset, batch_size=32, shuffle=True, num_workers=2)
+            test_dataset, batch_size=32, shuffle=True, num_workers=4, pin_memory=True)
 
         # learn the new task
         with model.set_new_task(current_task):
@@ -459,10 +470,6 @@ def continual_learning():
             reduced_label = exemplar_set[cls_name][1][:exemplar_size]
             exemplar_set[cls_name] = (reduced_image, reduced_label)
 
-            # note: after reducing the exemplar set, the cls mean need to be recalculated
-            model.exemplar_means[cls_name] = calculate_exemplar_mean(
-                "cifar100", reduced_image, reduced_label, model)
-
         # build exemplar sets for new classes
         for cls_name in current_task:
             cls_id = dataset_getter.cls_id_mapper[cls_name]
@@ -473,9 +480,9 @@ def continual_learning():
 
             exemplar_set[cls_name] = (exemplar_image, exemplar_label)
 
-            # save exemplar set means to model
-            model.exemplar_means[cls_name] = calculate_exemplar_mean(
-                "cifar100", exemplar_image, exemplar_label, model)
+        # note: after reducing the exemplar sets, the cls means need to be recalculated, so calculate means of all exemplar sets
+        model.set_exemplar_means(list(exemplar_set.keys()), calculate_exemplar_means(
+            "cifar100", exemplar_set, model))
 
         # save the test loader for continual learning testing
         learned_tasks.append(current_task)
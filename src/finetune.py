@@ -18,7 +18,7 @@ from model.finetune import Finetune
 from utils.helper import get_logger
 from utils.datasets import CLDatasetGetter
 from utils.helper import (plot_matrix, draw_image)
-from utils.helper import (get_probas, get_pred, to_khot)
+from utils.helper import (to_khot)
 from utils.helper import (get_top1_acc,
                           get_backward_transfer,
                           get_last_setp_accuracy,
@@ -40,8 +40,8 @@ device = torch.device("cuda:0")
 hparams_dict = {}
 
 
-def train_epoch(model: Finetune, train_loader: DataLoader, loss_func: nn.Module, optimizer: optim.Optimizer) -> torch.FloatTensor:
-    total_loss = 0
+def train_epoch(model: Finetune, train_loader: DataLoader, loss_func: nn.Module, optimizer: optim.Optimizer) -> float:
+    total_loss = torch.zeros((), device=device)
 
     total_num_classes = len(model.learned_classes) + len(model.current_task)
 
@@ -49,34 +49,35 @@ def train_epoch(model: Finetune, train_loader: DataLoader, loss_func: nn.Module,
     image: torch.FloatTensor
     label: torch.LongTensor
     for image, label in train_loader:
-        image = image.to(device)
-        label = to_khot(label, total_num_classes).to(device)
+        image = train_loader.dataset.augment(image.to(device, non_blocking=True))
+        label = to_khot(label.to(device, non_blocking=True), total_num_classes)
 
         logits = model(image)
         loss = loss_func(logits, label)
 
-        total_loss += loss.clone().detach()
+        total_loss.add_(loss.detach())
 
         optimizer.zero_grad()
         loss.backward()
         optimizer.step()
 
-    return total_loss / len(train_loader)
+    return (total_loss / len(train_loader)).item()
 
 
 @torch.no_grad()
-def test_epoch(model: Finetune, test_loader: DataLoader, perf_func: PerformanceFunc, num_cls_per_task: int) -> tuple[torch.FloatTensor, torch.FloatTensor]:
-    performance = []
+def test_epoch(model: Finetune, test_loader: DataLoader, perf_func: PerformanceFunc, num_cls_per_task: int) -> float:
+    performance = torch.zeros((), device=device)
+    num_batches = 0
 
     for image, label in test_loader:
-        image, label = image.to(device), label.to(device)
+        image, label = test_loader.dataset.augment(image.to(device, non_blocking=True)), label.to(device, non_blocking=True)
         logits = model(image)
-        probas = get_probas(logits)
-        preds = get_pred(probas)
-        performance.append(
+        preds = logits.argmax(dim=1)
+        performance.add_(
             perf_func(preds, label, len(model.learned_classes) + num_cls_per_task))
+        num_batches += 1
 
-    return sum(performance) / len(performance)
+    return (performance / num_batches).item()
 
 
 def get_task_learner() -> TaskLearner:
@@ -202,8 +203,10 @@ def continual_learning():
     learned_task_loaders: list[DataLoader] = []
     for task_id, current_task, train_dataset, test_dataset in dataset_getter:
         # prepare the data for the task
-        train_loader = DataLoader(train_dataset, batch_size=32, shuffle=True)
-        test_loader = DataLoader(test_dataset, batch_size=32, shuffle=True)
+        train_loader = DataLoader(
+            train_dataset, batch_size=32, shuffle=True, num_workers=4, pin_memory=True, persistent_workers=True, prefetch_factor=4)
+        test_loader = DataLoader(
+            test_dataset, batch_size=32, shuffle=True, num_workers=4, pin_memory=True)
 
         # learn the new task
         with model.set_new_task(current_task):
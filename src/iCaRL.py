@@ -1,18 +1,26 @@
 # Standard Library
+import os
+import math
 import argparse
+import itertools
 import datetime
 from pathlib import Path
 from typing import Optional
 
 # Third-Party Library
 import numpy as np
+from loguru import logger
 
 # Torch Library
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.optim as optim
+import torch._dynamo
+import torch.distributed as dist
+import torch.multiprocessing as mp
 import torch.optim.lr_scheduler
-from torch.utils.data import DataLoader
+from torch.nn.parallel import DistributedDataParallel
 from torch.optim.lr_scheduler import LRScheduler
 from torch.utils.tensorboard import SummaryWriter
 
@@ -21,13 +29,14 @@ from model.iCaRL import iCaRL
 from utils.annotation import Task
 from utils.helper import (get_logger,
                           get_parser)
-from utils.datasets import (get_dataset,
+from utils.datasets import (get_tasks,
+                            get_dataset,
+                            get_cls_names,
                             get_cls_data_getter,
                             CLDatasetGetter)
-from utils.transforms import get_transforms
-from utils.data.cifar100 import Cifar100Dataset
+from utils.data.cifar100 import Cifar100Dataset, Cifar100GPULoader
 from utils.helper import (plot_matrix, draw_image)
-from utils.helper import (get_probas, get_pred, to_khot)
+from utils.helper import (to_khot)
 from utils.helper import (get_top1_acc,
                           get_backward_transfer,
                           get_last_setp_accuracy,
@@ -41,76 +50,86 @@ from utils.annotation import (
     CLAbilityTester,
 )
 
-rname = input("the name of this running: ")
-wname = f"{rname}-{datetime.datetime.now().strftime('%m-%d %H.%M')}"
-writer = SummaryWriter(log_dir := f"log/{wname}")
-logger = get_logger(Path(log_dir) / "running.log")
+# Note: these are set up in main_worker, only the main process (rank 0) writes logs and tensorboard
+wname: str = None
+writer: SummaryWriter = None
 device = torch.device("cuda:0")
+is_main_process: bool = True
 
-hparams_dict = {}
-
+# Note: input shape is fixed, so let cuDNN pick the fastest convolution algorithms, and allow TF32 for matmul
+torch.backends.cudnn.benchmark = True
+torch.set_float32_matmul_precision("high")
 
-crop_size = 32
+hparams_dict = {}
 
 
-def train_epoch(model: iCaRL, train_loader: DataLoader, loss_func: nn.Module, optimizer: optim.Optimizer) -> float:
-    total_loss = 0
+def train_epoch(model: DistributedDataParallel, train_loader: Cifar100GPULoader, loss_func: nn.Module, optimizer: optim.Optimizer, scaler: torch.cuda.amp.GradScaler) -> float:
+    # Note: accumulate the loss on device, so that there is no synchronization per iteration
+    total_loss = torch.zeros((), device=device)
 
     sigmoid = nn.Sigmoid()
     distill_loss_func = nn.BCELoss(reduction="mean")
     classify_loss_func = nn.CrossEntropyLoss(reduction="mean")
 
-    total_num_classes = len(model.learned_classes) + len(model.current_task)
+    # Note: model is the compiled DistributedDataParallel wrapper, the teacher forward calls the unwrapped iCaRL, i.e., model.module, since it needs no gradient synchronization
+    cl_model: iCaRL = model.module
+
+    total_num_classes = len(cl_model.learned_classes) + len(cl_model.current_task)
 
     loss: torch.FloatTensor
     image: torch.FloatTensor
     label: torch.LongTensor
     for image, label in train_loader:
-        image = image.to(device)
-        label = to_khot(label, total_num_classes).to(device)
+        image = train_loader.dataset.augment(image).contiguous(
+            memory_format=torch.channels_last)
+        label = to_khot(label, total_num_classes)
 
         # for new classes, use cross entropy loss
-        logits = model(image)
-        classification_loss = classify_loss_func(logits, label)
+        # Note: only the forward runs in mixed precision, losses are computed in float32
+        with torch.autocast("cuda", dtype=torch.float16):
+            logits = model(image)
+        classification_loss = classify_loss_func(logits.float(), label)
 
         # for learned classes, use distillation loss, be cautious for the first task, there are no learned classes
         distillation_loss = torch.zeros_like(classification_loss)
-        if len(model.learned_classes) > 1:
+        if len(cl_model.learned_classes) > 1:
 
             # get the logits of last model, i.e., teacher logits
-            with torch.no_grad():
-                with model.use_previous_model():
+            with torch.no_grad(), torch.autocast("cuda", dtype=torch.float16):
+                with cl_model.use_previous_model():
                     # [B, Number of Learned Classes]
-                    teacher_logits = model(image)
+                    teacher_logits = cl_model(image)
 
             # get the logits of current model, i.e., student logits
+            # Note: reuse the logits above, DistributedDataParallel does not allow two forwards before one backward
             # [B, Number of Learned Classes + Number of Current Classes]
-            student_logits = model(image)
+            student_logits = logits
 
             # Note: iCaRL gives the logits as below, this mainly change the output logits to probability distribution
             # ref: Page 2, Architecture, Paragraph 2, Line 8: "The resulting network outputs are..."
-            teacher_logits = sigmoid(teacher_logits)
-            student_logits = sigmoid(student_logits)
+            teacher_logits = sigmoid(teacher_logits.float())
+            student_logits = sigmoid(student_logits.float())
 
             # get knowledge distillation loss
             # note, the output shape of teach logits and student logits are not the same, so alignment is necessary
             # The original paper just use the learned class logits of student logits to do distillation
             # ref: Page 3, Algorithm 3, \sum_{y=1}^{s-1}..., here y=1~s-1 means distill on learned class logits
             distillation_loss = distill_loss_func(
-                student_logits[:, :len(model.learned_classes)], teacher_logits)
+                student_logits[:, :len(cl_model.learned_classes)], teacher_logits)
 
         loss = classification_loss + distillation_loss
 
-        total_loss += loss.clone().detach()
+        total_loss.add_(loss.detach())
 
         optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
 
-    return total_loss / len(train_loader)
+    return (total_loss / len(train_loader)).item()
 
 
-def paper_train_epoch(model: iCaRL, train_loader: DataLoader, loss_func: nn.Module, optimizer: optim.Optimizer) -> float:
+def paper_train_epoch(model: DistributedDataParallel, train_loader: Cifar100GPULoader, loss_func: nn.Module, optimizer: optim.Optimizer, scaler: torch.cuda.amp.GradScaler, replay_data: Optional[tuple[torch.FloatTensor, torch.LongTensor]] = None) -> float:
     """
     This is the training code of original paper, which uses BCE loss for both new classes and learned classes.
 
@@ -119,75 +138,106 @@ def paper_train_epoch(model: iCaRL, train_loader: DataLoader, loss_func: nn.Modu
     After the training, new classes exemplar is generated using the model and is used to classify. So, since the CrossEntropy loss gets a
     better feature extractor, the above training code gets better results on all classes.
     """
-    total_loss = 0
+    total_loss = torch.zeros((), device=device)
 
     sigmoid = nn.Sigmoid()
     loss_func = nn.BCEWithLogitsLoss(reduction="mean")
 
-    total_num_classes = len(model.learned_classes) + len(model.current_task)
+    cl_model: iCaRL = model.module
+
+    total_num_classes = len(cl_model.learned_classes) + len(cl_model.current_task)
+
+    # for latent replay, split the shuffled exemplar features into one chunk per batch
+    # Note: every chunk has the same size, so the shape of each step is static, the left exemplars are replayed in other epochs
+    replay_chunks = itertools.repeat(None)
+    if replay_data is not None:
+        replay_features, replay_labels = replay_data
+        num_exemplars, num_steps = replay_labels.size(0), len(train_loader)
+        num_replay = max(num_exemplars // num_steps, 1)
+
+        # the permutation is repeated only if there are fewer exemplars than steps
+        replay_order = torch.randperm(num_exemplars, device=device).repeat(
+            math.ceil(num_replay * num_steps / num_exemplars))
+        # [num_steps, num_replay]
+        replay_chunks = replay_order[:num_replay * num_steps].view(num_steps, num_replay)
 
     loss: torch.FloatTensor
     image: torch.FloatTensor
     label: torch.LongTensor
-    for image, label in train_loader:
-        image = image.to(device)
-        label = to_khot(label, total_num_classes).to(device)
+    batch_replay_features: Optional[torch.FloatTensor]
+    for (image, label), replay_indices in zip(train_loader, replay_chunks):
+        image = train_loader.dataset.augment(image).contiguous(
+            memory_format=torch.channels_last)
+
+        # replayed exemplars are appended after the images of the batch
+        batch_replay_features = None
+        if replay_indices is not None:
+            batch_replay_features = replay_features[replay_indices]
+            label = torch.cat((label, replay_labels[replay_indices]), dim=0)
+
+        label = to_khot(label, total_num_classes)
 
         # get the logits of current model
-        logits = model(image)
+        with torch.autocast("cuda", dtype=torch.float16):
+            logits = model(image, batch_replay_features)
 
         # get logits of previous model for learned classes, be cautious for the first task, there are no learned classes
-        if len(model.learned_classes) > 0:
+        if len(cl_model.learned_classes) > 0:
 
             # get the logits of last model, i.e., teacher logits
-            with torch.no_grad():
-                with model.use_previous_model():
-                    # [B, Number of Learned Classes]
-                    teacher_logits = model(image)
+            with torch.no_grad(), torch.autocast("cuda", dtype=torch.float16):
+                with cl_model.use_previous_model():
+                    # [B (+ R), Number of Learned Classes]
+                    teacher_logits = cl_model(image, batch_replay_features)
 
             # Note: iCaRL gives the logits as below, this mainly change the output logits to probability distribution
             # ref: Page 2, Architecture, Paragraph 2, Line 8: "The resulting network outputs are..."
-            teacher_logits = sigmoid(teacher_logits)
+            teacher_logits = sigmoid(teacher_logits.float())
 
             # get knowledge distillation loss
             # note, the output shape of teach logits and student logits are not the same, so alignment is necessary
             # The original paper just use the learned class logits of student logits to do distillation
             # ref: Page 3, Algorithm 3, \sum_{y=1}^{s-1}..., here y=1~s-1 means distill on learned class logits
-            label[:, :len(model.learned_classes)] = teacher_logits
+            label[:, :len(cl_model.learned_classes)] = teacher_logits
 
-        loss = loss_func(logits, label)
+        loss = loss_func(logits.float(), label)
 
         optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
 
-        total_loss += loss.clone().detach()
+        total_loss.add_(loss.detach())
 
-    return total_loss / len(train_loader)
+    return (total_loss / len(train_loader)).item()
 
 
 @torch.no_grad()
-def test_epoch(model: iCaRL, test_loader: DataLoader, perf_func: PerformanceFunc, num_cls_per_task: int) -> tuple[torch.FloatTensor, torch.FloatTensor]:
-    performance = []
+def test_epoch(model: iCaRL, test_loader: Cifar100GPULoader, perf_func: PerformanceFunc, num_cls_per_task: int) -> float:
+    # Note: accumulate the performance on device, and synchronize only once at the end
+    performance = torch.zeros((), device=device)
+    num_batches = 0
 
     # Note: iCaRL use Nearest-Mean-of-Exemplars to classify, here using output logits just for monitor the learning
     for image, label in test_loader:
-        image, label = image.to(device), label.to(device)
-        preds = get_pred(get_probas(model(image)))
-        performance.append(
+        image = test_loader.dataset.augment(image)
+        # Note: softmax is monotonic, so argmax of logits gives the same top-1 prediction without the softmax
+        preds = model(image).argmax(dim=1)
+        performance.add_(
             perf_func(preds, label, len(model.learned_classes) + num_cls_per_task))
+        num_batches += 1
 
-    return sum(performance) / len(performance)
+    return (performance / num_batches).item()
 
 
 @torch.no_grad()
-def calculate_cls_features(cls_data_loader: DataLoader, model: iCaRL) -> torch.FloatTensor:
+def calculate_cls_features(cls_data_loader: Cifar100GPULoader, model: iCaRL) -> torch.FloatTensor:
     cls_features = []
 
     image: torch.FloatTensor
     features: torch.FloatTensor
     for image, _ in cls_data_loader:
-        image = image.to(device)
+        image = cls_data_loader.dataset.augment(image)
         features = model.feature_extractor(image)
         features = features / features.norm(p=2, dim=1, keepdim=True)
         cls_features.append(features)
@@ -195,22 +245,58 @@ def calculate_cls_features(cls_data_loader: DataLoader, model: iCaRL) -> torch.F
     return torch.cat(cls_features, dim=0)
 
 
-@torch.no_grad()
-def calculate_exemplar_mean(dataset: SupportedDataset, exemplar_image: Images, exemplar_label: Labels, model: iCaRL) -> torch.FloatTensor:
-    # use test transforms here, for the predictions is made on test images
-    _, transforms = get_transforms(
-        dataset=dataset, crop_size=crop_size, same_crop=False)
+def get_exemplar_loader(dataset: SupportedDataset, exemplar_set: dict[str, tuple[Images, Labels]]) -> Cifar100GPULoader:
+    # use test transforms here, for the predictions is made on test images and the replayed features are not augmented
+    _, transforms = get_dataset(dataset).get_transforms()
+
+    # exemplars of all classes, in the order of exemplar_set
+    exemplar_image = np.concatenate(
+        [image for image, _ in exemplar_set.values()], axis=0)
+    exemplar_label = np.concatenate(
+        [label for _, label in exemplar_set.values()], axis=0)
 
     exemplar_dataset = get_dataset(dataset)(
         exemplar_image, exemplar_label, transforms)
 
-    exemplar_loader = DataLoader(
-        exemplar_dataset, batch_size=32, shuffle=False, num_workers=2)
+    return Cifar100GPULoader(exemplar_dataset, batch_size=32, shuffle=False, device=device)
 
-    # [N, 512]
-    cls_features = calculate_cls_features(exemplar_loader, model)
 
-    return cls_features.mean(dim=0, keepdim=True)
+@torch.no_grad()
+def calculate_exemplar_means(dataset: SupportedDataset, exemplar_set: dict[str, tuple[Images, Labels]], model: iCaRL) -> torch.FloatTensor:
+    # Note: the features of all exemplar sets are calculated in one pass, and averaged per class with a single matmul
+    exemplar_loader = get_exemplar_loader(dataset, exemplar_set)
+
+    # [N_ex, 512]
+    exemplar_features = calculate_cls_features(exemplar_loader, model)
+
+    # [N_ex], the position of the class of each exemplar in exemplar_set
+    exemplar_position = torch.repeat_interleave(
+        torch.arange(len(exemplar_set), device=device),
+        torch.tensor([len(label) for _, label in exemplar_set.values()], device=device))
+
+    # [N_cls, N_ex], row-normalized class-assignment matrix
+    assignment = F.one_hot(exemplar_position, num_classes=len(
+        exemplar_set)).T.to(exemplar_features.dtype)
+    assignment = assignment / assignment.sum(dim=1, keepdim=True)
+
+    # [N_cls, 512]
+    return assignment @ exemplar_features
+
+
+@torch.no_grad()
+def calculate_exemplar_features(dataset: SupportedDataset, exemplar_set: dict[str, tuple[Images, Labels]], model: iCaRL) -> list[torch.FloatTensor]:
+    # the features of all exemplar sets are calculated in one pass, and split per class
+    exemplar_loader = get_exemplar_loader(dataset, exemplar_set)
+
+    # [N_ex, 512]
+    exemplar_features = torch.cat([
+        model.get_backbone_features(exemplar_loader.dataset.augment(image).contiguous(
+            memory_format=torch.channels_last))
+        for image, _ in exemplar_loader
+    ], dim=0)
+
+    # N_cls x [M, 512]
+    return list(exemplar_features.split([len(label) for _, label in exemplar_set.values()], dim=0))
 
 
 @torch.no_grad()
@@ -220,13 +306,12 @@ def build_exemplar_set(dataset: SupportedDataset, cls_name: str, cls_id: int, ex
     cls_images, cls_labels = cls_data_getter(cls_name, cls_id)
 
     # use test transforms here, for the predictions is made on test images
-    _, transforms = get_transforms(
-        dataset=dataset, crop_size=crop_size, same_crop=False)
+    _, transforms = get_dataset(dataset).get_transforms()
 
     cls_data_dataset = get_dataset(dataset)(cls_images, cls_labels, transforms)
 
-    cls_data_loader = DataLoader(
-        cls_data_dataset, batch_size=32, shuffle=False, num_workers=2)
+    cls_data_loader = Cifar100GPULoader(
+        cls_data_dataset, batch_size=32, shuffle=False, device=device)
 
     # get features
     # [N, 512]
@@ -280,23 +365,35 @@ def build_exemplar_set(dataset: SupportedDataset, cls_name: str, cls_id: int, ex
 def get_task_learner() -> TaskLearner:
     num_task_learned = 0
 
-    def task_learner(task_id: int, current_task: list[str], num_cls_per_task: int, model: iCaRL, train_loader: DataLoader, test_loader: DataLoader) -> iCaRL:
+    def task_learner(task_id: int, current_task: list[str], num_cls_per_task: int, model: iCaRL, train_loader: Cifar100GPULoader, test_loader: Cifar100GPULoader, replay_data: Optional[tuple[torch.FloatTensor, torch.LongTensor]] = None) -> iCaRL:
 
         loss_func = nn.CrossEntropyLoss()
 
         # Note: if use SGD, the performance is much more weaker than use Adam
         # Note: this may because of the original code uses gradient clip
-        optimizer = optim.Adam(model.parameters(), lr=1e-3, weight_decay=1e-5)
+        # Note: fused Adam updates all parameters in a single kernel, since the optimizer step is not in the CUDA graph of the compiled model
+        optimizer = optim.Adam(model.parameters(), lr=1e-3,
+                               weight_decay=1e-5, fused=True)
         # optimizer = optim.SGD(model.parameters(), lr=1e-3, weight_decay=5e-5)
 
         scheduler = torch.optim.lr_scheduler.MultiStepLR(
             optimizer, milestones=[49, 63], gamma=0.2)
 
+        scaler = torch.cuda.amp.GradScaler()
+
+        # Note: set_new_task changes the number of used weight vectors, so the model is wrapped again for every task
+        # Note: compile the wrapper rather than the wrapped model, so that the compiler splits the graph at the gradient
+        # Note: buckets of DistributedDataParallel and the all-reduce of a bucket overlaps with the rest of the backward
+        ddp_model = torch.compile(DistributedDataParallel(
+            model, device_ids=[device.index]), mode="reduce-overhead", dynamic=False)
+
         log_times = 5
         num_epoch = 70
         for epoch in range(num_epoch):
+            train_loader.set_epoch(epoch)
+
             train_loss = paper_train_epoch(
-                model, train_loader, loss_func, optimizer)
+                ddp_model, train_loader, loss_func, optimizer, scaler, replay_data)
 
             test_top1_acc = test_epoch(model, test_loader, get_top1_acc,
                                        num_cls_per_task) * 100
@@ -314,9 +411,10 @@ def get_task_learner() -> TaskLearner:
             }
 
             # watch training
-            for watcher_name, watcher_value in training_watcher.items():
-                writer.add_scalar(f"Task Learning/{watcher_name}",
-                                  scalar_value=watcher_value, global_step=epoch + task_id * num_epoch)
+            if is_main_process:
+                for watcher_name, watcher_value in training_watcher.items():
+                    writer.add_scalar(f"Task Learning/{watcher_name}",
+                                      scalar_value=watcher_value, global_step=epoch + task_id * num_epoch)
 
         # log hparams
         nonlocal num_task_learned
@@ -349,25 +447,27 @@ def get_continual_learning_ability_tester(task_num: int, num_cls_per_task: int)
     })
 
     @ torch.no_grad
-    def continual_learning_ability_tester(task_id: int, learned_tasks: list[list[str]], learned_task_loaders: list[DataLoader], model: iCaRL) -> tuple[np.ndarray, dict[str, float]]:
+    def continual_learning_ability_tester(task_id: int, learned_tasks: list[list[str]], learned_task_loaders: list[Cifar100GPULoader], model: iCaRL) -> tuple[np.ndarray, dict[str, float]]:
         nonlocal cl_matrix, num_cls_per_task, metrics_getter
 
         # test on all tasks, including previous and current task
         for i, previous_loader in enumerate(learned_task_loaders):
 
             # iCaRL use Nearest-Mean-of-Exemplar to classify, so use that here
-            performance = []
+            performance = torch.zeros((), device=device)
+            num_batches = 0
 
             image: torch.FloatTensor
             label: torch.FloatTensor
             for image, label in previous_loader:
-                image, label = image.to(device), label.to(device)
+                image = previous_loader.dataset.augment(image)
                 preds = model.get_preds(image)
-                performance.append(
+                performance.add_(
                     get_top1_acc(preds, label, len(model.learned_classes))
                 )
+                num_batches += 1
 
-            cl_matrix[i, task_id] = sum(performance) / len(performance)
+            cl_matrix[i, task_id] = (performance / num_batches).item()
 
             logger.info(
                 f"\ttest on task {i}, test_acc={cl_matrix[i, task_id]: .2f}, {learned_tasks[i]}")
@@ -380,7 +480,7 @@ def get_continual_learning_ability_tester(task_num: int, num_cls_per_task: int)
 
             # log to summarywriter
             for metric_name, metric_value in current_metrics.items():
-                if isinstance(metric_value, (float, int)):
+                if is_main_process and isinstance(metric_value, (float, int)):
                     writer.add_scalar(
                         tag=f"Continual Learning Metrics/{metric_name}",
                         scalar_value=metric_value,
@@ -388,11 +488,12 @@ def get_continual_learning_ability_tester(task_num: int, num_cls_per_task: int)
                     )
 
         # draw heatmap of cl_matrix and log to summarywriter
-        writer.add_figure(
-            tag=f"cl_matrix/{wname}",
-            figure=plot_matrix(cl_matrix, task_id),
-            global_step=task_id,
-        )
+        if is_main_process:
+            writer.add_figure(
+                tag=f"cl_matrix/{wname}",
+                figure=plot_matrix(cl_matrix, task_id),
+                global_step=task_id,
+            )
 
         return cl_matrix, current_metrics if task_id >= 1 else {}
 
@@ -401,12 +502,26 @@ def get_continual_learning_ability_tester(task_num: int, num_cls_per_task: int)
 
 def continual_learning(args: argparse.Namespace):
 
+    # Note: tasks and the shuffle seed are random for every run, so all processes use the ones of the main process
+    dist_objects = [get_tasks(args.dataset, get_cls_names(args.dataset), args.num_tasks, args.fixed_tasks),
+                    torch.initial_seed() % 2 ** 32]
+    dist.broadcast_object_list(dist_objects, src=0)
+    tasks, seed = dist_objects
+
     dataset_getter = CLDatasetGetter(
-        dataset=args.dataset, task_num=args.num_tasks, fixed_task=args.fixed_tasks)
+        dataset=args.dataset, task_num=args.num_tasks, fixed_task=args.fixed_tasks, given_tasks=tasks)
 
     model: iCaRL
     model = iCaRL().to(device)
 
+    # Note: the student is compiled together with its DistributedDataParallel wrapper in task_learner, the teacher is not
+    # Note: wrapped, so compile the previous feature extractor in-place, which keeps its state_dict keys unchanged
+    # Note: set_new_task changes the used weight vectors, which re-specializes the compiled graph, so allow enough cached
+    # Note: graphs for all tasks (train/no_grad, replay or not)
+    torch._dynamo.config.cache_size_limit = max(
+        torch._dynamo.config.cache_size_limit, 8 * args.num_tasks)
+    model.previous_feature_extractor.compile(mode="reduce-overhead", dynamic=False)
+
     # iCaRL needs a exemplar set
     total_exemplar_size = args.buffer_size
     exemplar_set: dict[str, tuple[Images, Labels]] = {}
@@ -426,33 +541,42 @@ def continual_learning(args: argparse.Namespace):
     train_dataset: Cifar100Dataset
     test_dataset: Cifar100Dataset
     learned_tasks: list[Task] = []
-    learned_task_loaders: list[DataLoader] = []
+    learned_task_loaders: list[Cifar100GPULoader] = []
     for task_id, current_task, train_dataset, test_dataset in dataset_getter:
         # prepare the data for the task
 
         # merge exemplar set into current training dataset
         exemplar_images: Images
         exemplar_labels: Labels
-        for exemplar_images, exemplar_labels in exemplar_set.values():
-            current_task_images: Images = train_dataset.images
-            current_task_labels: Labels = train_dataset.labels
-            train_dataset.images = np.concatenate(
-                (current_task_images, exemplar_images), axis=0)
-            train_dataset.labels = np.concatenate(
-                (current_task_labels, exemplar_labels), axis=0)
+        replay_data: Optional[tuple[torch.FloatTensor,
+                                    torch.LongTensor]] = None
+        if not args.latent_replay:
+            for exemplar_images, exemplar_labels in exemplar_set.values():
+                train_dataset.append(exemplar_images, exemplar_labels)
+        elif len(exemplar_set) > 0:
+            # for latent replay, replay the cached backbone features of exemplars instead, each process replays its own shard
+            replay_features = torch.cat(
+                [model.exemplar_features[cls_name] for cls_name in exemplar_set], dim=0)
+            replay_labels = torch.from_numpy(np.concatenate(
+                [exemplar_labels for _, exemplar_labels in exemplar_set.values()])).to(device)
+            replay_data = (replay_features[dist.get_rank()::dist.get_world_size()],
+                           replay_labels[dist.get_rank()::dist.get_world_size()])
 
         # get dataloader
-        train_loader = DataLoader(
-            train_dataset, batch_size=32, shuffle=True, num_workers=2)
-        test_loader = DataLoader(
-            test_dataset, batch_size=32, shuffle=False, num_workers=2)
+        # Note: the data of the task is copied to the GPU once, and batches are sliced there
+        # Note: each process trains on its own shard of the training data, while testing is done on the whole test data
+        # Note: drop the last incomplete batch, so the training step has static shapes and its CUDA graph is captured once per task
+        train_loader = Cifar100GPULoader(
+            train_dataset, batch_size=32, shuffle=True, device=device, rank=dist.get_rank(), world_size=dist.get_world_size(), seed=seed, drop_last=True)
+        test_loader = Cifar100GPULoader(
+            test_dataset, batch_size=32, shuffle=False, device=device)
 
         # learn the new task
         with model.set_new_task(current_task):
 
             logger.success(f"{task_id=}, {current_task=}")
             model = task_learner(
-                task_id, current_task, dataset_getter.num_cls_per_task, model, train_loader, test_loader)
+                task_id, current_task, dataset_getter.num_cls_per_task, model, train_loader, test_loader, replay_data)
 
         # exemplar set management
         # reduce existing exemplar sets
@@ -463,10 +587,6 @@ def continual_learning(args: argparse.Namespace):
             reduced_label = exemplar_set[cls_name][1][:exemplar_size]
             exemplar_set[cls_name] = (reduced_image, reduced_label)
 
-            # note: after reducing the exemplar set, the cls mean need to be recalculated
-            model.exemplar_means[cls_name] = calculate_exemplar_mean(
-                "cifar100", reduced_image, reduced_label, model)
-
         # build exemplar sets for new classes
         for cls_name in current_task:
             cls_id = dataset_getter.cls_id_mapper[cls_name]
@@ -477,9 +597,14 @@ def continual_learning(args: argparse.Namespace):
 
             exemplar_set[cls_name] = (exemplar_image, exemplar_label)
 
-            # save exemplar set means to model
-            model.exemplar_means[cls_name] = calculate_exemplar_mean(
-                "cifar100", exemplar_image, exemplar_label, model)
+        # note: after reducing the exemplar sets, the cls means need to be recalculated, so calculate means of all exemplar sets
+        model.set_exemplar_means(list(exemplar_set.keys()), calculate_exemplar_means(
+            "cifar100", exemplar_set, model))
+
+        # compute the backbone features of all exemplars once, with the feature extractor that is the teacher of the next task
+        if args.latent_replay:
+            for cls_name, features in zip(exemplar_set, calculate_exemplar_features("cifar100", exemplar_set, model)):
+                model.set_exemplar_features(cls_name, features)
 
         # save the test loader for continual learning testing
         learned_tasks.append(current_task)
@@ -494,11 +619,12 @@ def continual_learning(args: argparse.Namespace):
                           0] if task_id == 0 else metrics["Last Step Accuracy"]
         metrics["Average Accuracy of Learned Classes"] = value
 
-        writer.add_scalar(
-            tag="iCaRL/Average Accuracy of Learned Classes",
-            scalar_value=value,
-            global_step=task_id
-        )
+        if is_main_process:
+            writer.add_scalar(
+                tag="iCaRL/Average Accuracy of Learned Classes",
+                scalar_value=value,
+                global_step=task_id
+            )
 
         if metrics is not None:
             logger.debug(
@@ -528,12 +654,46 @@ def get_args() -> argparse.Namespace:
     parser.description = "Train iCaRL"
     parser.add_argument("-b", "--buffer_size", type=int,
                         default=2000, help="size of buffer, i.e. examplar size")
+    parser.add_argument("-l", "--latent_replay", default=False, action="store_true",
+                        help="replay cached backbone features of exemplars instead of exemplar images")
     args = parser.parse_args()
+
+    return args
+
+
+def main_worker(rank: int, world_size: int, run_name: str, args: argparse.Namespace):
+    global wname, writer, device, is_main_process
+
+    dist.init_process_group("nccl", rank=rank, world_size=world_size)
+
+    device = torch.device(f"cuda:{rank}")
+    torch.cuda.set_device(device)
+
+    # only the main process writes logs and tensorboard
+    wname = run_name
+    is_main_process = rank == 0
+    if is_main_process:
+        writer = SummaryWriter(log_dir := f"log/{wname}")
+        get_logger(Path(log_dir) / "running.log")
+    else:
+        logger.remove()
+
     for key, value in vars(args).items():
         logger.info(f"{key}: {value}")
 
-    return args
+    try:
+        continual_learning(args)
+    finally:
+        dist.destroy_process_group()
 
 
 if __name__ == "__main__":
-    continual_learning(get_args())
+    rname = input("the name of this running: ")
+    run_name = f"{rname}-{datetime.datetime.now().strftime('%m-%d %H.%M')}"
+
+    os.environ.setdefault("MASTER_ADDR", "localhost")
+    os.environ.setdefault("MASTER_PORT", "29500")
+
+    world_size = torch.cuda.device_count()
+    mp.spawn(main_worker, args=(world_size, run_name, get_args()),
+             nprocs=world_size, join=True)
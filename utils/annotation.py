@@ -15,6 +15,8 @@ Task = list[str]
 Images = np.ndarray
 Labels = np.ndarray
 
+Indices = np.ndarray
+
 Split = Literal["train", "val", "test"]
 
 SupportedDataset = Literal["cifar100"]
@@ -25,7 +27,7 @@ TorchDatasetImplementation = TypeVar("TorchDatasetImplementation")
 
 ClassDataGetter = Callable[[str, int], tuple[Images, Labels]]
 
-TaskDataGetter = Callable[[Task, list[int]], tuple[Images, Labels]]
+TaskDataGetter = Callable[[Task, list[int]], tuple[Images, Labels, Indices]]
 
 PerformanceFunc = Callable[[torch.FloatTensor,
                             torch.FloatTensor, int], torch.FloatTensor]
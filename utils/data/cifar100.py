@@ -1,5 +1,6 @@
 # Standard Library
 import copy
+import math
 import random
 import pickle
 from pathlib import Path
@@ -12,12 +13,12 @@ import numpy as np
 # Torch Library
 import torch
 import torch.nn as nn
-import torchvision.transforms as transforms
+import torch.nn.functional as F
 from torch.utils.data import Dataset
 from torchvision.datasets.utils import check_integrity, download_and_extract_archive
 
 # My Library
-from ..annotation import Task, Images, Labels, Split, ClassDataGetter
+from ..annotation import Task, Images, Labels, Indices, Split, ClassDataGetter
 
 
 CIFAR_PATH: Path = (Path(__file__).resolve() /
@@ -66,6 +67,11 @@ def get_cifar100_cls_names() -> list[str]:
     return data['fine_label_names']
 
 
+@lru_cache(maxsize=1)
+def _get_cifar100_cls_id_mapper() -> dict[str, int]:
+    return {name: id for id, name in enumerate(get_cifar100_cls_names())}
+
+
 def get_cifar100_tasks(cls_names: list[str], task_num: int = 10, fixed_tasks: bool = False) -> list[Task]:
     if fixed_tasks:
         return [
@@ -108,13 +114,13 @@ def get_cifar100_data(split: Split) -> tuple[Images, Labels]:
     with file.open(mode="rb") as f:
         data = pickle.load(f, encoding="bytes")
 
-    images = data[b"data"].reshape(-1, 3, 32, 32).transpose(0, 2, 3, 1)
+    # Note: keep the native [N, C, H, W] layout, so images stay contiguous and need no permute when converted to tensor
+    images = np.ascontiguousarray(data[b"data"].reshape(-1, 3, 32, 32))
     labels = np.array(data[b"fine_labels"], dtype=np.int64)
 
     # these codes are not used
     if split != "test" and False:
-        cls_id_mapper = {cls_name: cls_id for cls_id,
-                         cls_name in enumerate(get_cifar100_cls_names())}
+        cls_id_mapper = _get_cifar100_cls_id_mapper()
 
         cls_masks = [labels == cls_id for cls_id in cls_id_mapper.values()]
 
@@ -132,23 +138,40 @@ def get_cifar100_data(split: Split) -> tuple[Images, Labels]:
     return images, labels
 
 
+@lru_cache(maxsize=3)
+def get_cifar100_cls_indices(split: Split) -> list[Indices]:
+    """
+    Args:
+        split (Split): split of the dataset
+    Returns:
+        list[Indices]: row indices of each class in the images of the split, indexed by the original cls_id
+    """
+    labels: Labels
+    _, labels = get_cifar100_data(split)
+
+    # Note: after a stable sort, the data of each class is a contiguous slice of order, in their original order
+    order = np.argsort(labels, kind="stable").astype(np.int32)
+    bounds = np.searchsorted(
+        labels[order], np.arange(len(get_cifar100_cls_names()) + 1))
+
+    return [order[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+
 @lru_cache(maxsize=3)
 def get_cifar100_cls_data_getter(split: Split) -> ClassDataGetter:
 
     # get the cls_id
-    cls_names = get_cifar100_cls_names()
-    cls_id_mapper = {name: id for id, name in enumerate(cls_names)}
+    cls_id_mapper = _get_cifar100_cls_id_mapper()
 
     # read data
     images: Images
-    labels: Labels
-    images, labels = get_cifar100_data(split)
+    images, _ = get_cifar100_data(split)
+    cls_indices = get_cifar100_cls_indices(split)
 
     def cls_data_getter(cls_name: str, new_cls_id: int) -> tuple[Images, Labels]:
 
         # get class data
-        cls_mask = labels == cls_id_mapper[cls_name]
-        cls_images = images[cls_mask]
+        cls_images = images[cls_indices[cls_id_mapper[cls_name]]]
         cls_labels = np.full((cls_images.shape[0],), fill_value=new_cls_id)
 
         return cls_images, cls_labels
@@ -156,65 +179,273 @@ def get_cifar100_cls_data_getter(split: Split) -> ClassDataGetter:
     return cls_data_getter
 
 
-def get_cifar100_task_data(split: Split, task: Task, cls_ids: list[int]) -> tuple[Images, Labels]:
+def get_cifar100_task_data(split: Split, task: Task, cls_ids: list[int]) -> tuple[Images, Labels, Indices]:
+    """
+    Args:
+        split (Split): split of the dataset
+        task (Task): classes of the task
+        cls_ids (list[int]): new cls_id of each class in the task
+    Returns:
+        tuple[Images, Labels, Indices]: images of the whole split, labels of the task and row indices of the task in the
+            images. The images are shared by all tasks and not copied, index them with the indices to get the task data.
+    """
+
+    # get the original cls_id of classes in the task
+    cls_id_mapper = _get_cifar100_cls_id_mapper()
+
+    # read data
+    images: Images
+    images, _ = get_cifar100_data(split)
+    cls_indices = get_cifar100_cls_indices(split)
+
+    # keep the data grouped by class, in the order of classes in the task
+    task_cls_indices = [cls_indices[cls_id_mapper[cls_name]]
+                        for cls_name in task]
+    task_indices = np.concatenate(task_cls_indices)
+
+    # map the original cls_id to the new cls_id
+    task_labels = np.repeat(np.asarray(cls_ids, dtype=np.int64), [
+                            len(indices) for indices in task_cls_indices])
+
+    return images, task_labels, task_indices
 
-    images: list[Images]
-    labels: list[Labels]
-    images, labels = [], []
 
-    cls_data_getter = get_cifar100_cls_data_getter(split)
+class Cifar100BatchTransform(nn.Module):
+    """
+    Batched transform of Cifar100 images.
 
-    for cls_id, cls_name in zip(cls_ids, task):
-        cls_image, cls_label = cls_data_getter(cls_name, cls_id)
-        images.append(cls_image)
-        labels.append(cls_label)
+    The transform takes uint8 images of shape [B, C, H, W] and runs on the device of the images, so that the conversion,
+    augmentation and normalization are done once per batch on the GPU, instead of once per sample in the DataLoader workers.
+    """
+
+    def __init__(
+        self,
+        is_eval: bool,
+        mean: tuple[float, float, float] = (0.5071, 0.4867, 0.4408),
+        std: tuple[float, float, float] = (0.2675, 0.2565, 0.2761),
+        padding: int = 4,
+    ) -> None:
+        super().__init__()
+        self.is_eval = is_eval
+        self.padding = padding
+        self.register_buffer("mean", torch.tensor(mean).view(1, -1, 1, 1))
+        self.register_buffer("std", torch.tensor(std).view(1, -1, 1, 1))
 
-    return np.concatenate(images), np.concatenate(labels)
+    def random_crop(self, image: torch.FloatTensor) -> torch.FloatTensor:
+        # same as transforms.RandomCrop(32, padding=4), but each image in the batch gets its own crop
+        b, _, h, w = image.shape
+        padded = F.pad(image, [self.padding] * 4)
+
+        # [B, 1]
+        offset_y = torch.randint(
+            0, 2 * self.padding + 1, (b, 1), device=image.device)
+        offset_x = torch.randint(
+            0, 2 * self.padding + 1, (b, 1), device=image.device)
+
+        # [B, 1, H, 1] and [B, 1, 1, W]
+        rows = (offset_y + torch.arange(h, device=image.device))[:, None, :, None]
+        cols = (offset_x + torch.arange(w, device=image.device))[:, None, None, :]
+
+        batch_idx = torch.arange(b, device=image.device)[:, None, None, None]
+        channel_idx = torch.arange(
+            image.size(1), device=image.device)[None, :, None, None]
+
+        return padded[batch_idx, channel_idx, rows, cols]
+
+    def random_flip(self, image: torch.FloatTensor) -> torch.FloatTensor:
+        # same as transforms.RandomHorizontalFlip(), but each image in the batch gets its own flip
+        flip_mask = torch.rand(image.size(0), device=image.device) < 0.5
+        return torch.where(flip_mask[:, None, None, None], image.flip(dims=(3,)), image)
+
+    def forward(self, image: torch.ByteTensor) -> torch.FloatTensor:
+        """
+        Args:
+            image (torch.ByteTensor): input uint8 images, shape [B, C, H, W]
+        Returns:
+            torch.FloatTensor: transformed images, shape [B, C, H, W]
+        """
+        if self.mean.device != image.device:
+            self.to(image.device)
+
+        image = image.float().div_(255)
+
+        if not self.is_eval:
+            image = self.random_flip(self.random_crop(image))
+
+        return image.sub_(self.mean).div_(self.std)
 
 
 class Cifar100Dataset(Dataset):
 
     @staticmethod
-    def get_transforms() -> tuple[transforms.Compose, transforms.Compose]:
-        train_transform = transforms.Compose([
-            transforms.ToPILImage(),
-            transforms.RandomCrop(32, padding=4),
-            transforms.RandomHorizontalFlip(),
-            transforms.ToTensor(),
-            transforms.Normalize(
-                mean=(0.5071, 0.4867, 0.4408),
-                std=(0.2675, 0.2565, 0.2761)
-            )
-        ])
-        test_transform = transforms.Compose([
-            transforms.ToTensor(),
-            transforms.Normalize(
-                mean=(0.5071, 0.4867, 0.4408),
-                std=(0.2675, 0.2565, 0.2761)
-            )
-        ])
-        return train_transform, test_transform
-
-    def __init__(self, images: Images, labels: Labels, transforms: Optional[nn.Module] = None) -> None:
+    def get_transforms() -> tuple[Cifar100BatchTransform, Cifar100BatchTransform]:
+        return Cifar100BatchTransform(is_eval=False), Cifar100BatchTransform(is_eval=True)
+
+    def __init__(self, images: Images, labels: Labels, transforms: Optional[nn.Module] = None, indices: Optional[Indices] = None) -> None:
         super().__init__()
+        # Note: if indices is given, images are shared with other datasets and the data of this dataset is images[indices]
         self.images = images
+        self.indices = indices
         self.labels = labels
         self.transforms = transforms
 
+        # Note: appended data, e.g., exemplars, is kept apart from the shared images, its labels follow the labels of the rows
+        self.appended_images: Optional[Images] = None
+
+    @property
+    def num_rows(self) -> int:
+        return len(self.images) if self.indices is None else len(self.indices)
+
+    def append(self, images: Images, labels: Labels) -> None:
+        """
+        Args:
+            images (Images): images to append, shape [M, C, H, W]
+            labels (Labels): labels of the images, shape [M]
+        """
+        if len(images) == 0:
+            return
+
+        self.appended_images = images if self.appended_images is None else np.concatenate(
+            (self.appended_images, images), axis=0)
+        self.labels = np.concatenate((self.labels, labels), axis=0)
+
     def __len__(self) -> int:
         return len(self.labels)
 
-    def __getitem__(self, index: int) -> tuple[torch.FloatTensor, torch.FloatTensor]:
-        # get image
-        image = self.images[index]
+    def __getitem__(self, index: int) -> tuple[torch.ByteTensor, torch.LongTensor]:
+        # Note: the image is returned as raw uint8 tensor of shape [C, H, W], call augment on the batch after moving it to the device
+        if index >= self.num_rows:
+            image = self.appended_images[index - self.num_rows]
+        else:
+            image = self.images[index if self.indices is None else self.indices[index]]
+
+        return torch.from_numpy(image), self.labels[index]
+
+    def augment(self, image: torch.ByteTensor) -> torch.FloatTensor:
+        """
+        Args:
+            image (torch.ByteTensor): batched uint8 images, shape [B, C, H, W]
+        Returns:
+            torch.FloatTensor: transformed images, shape [B, C, H, W]
+        """
+        return image.float().div(255) if self.transforms is None else self.transforms(image)
+
+
+# Note: the shared images of a split are copied to each device only once, and indexed by the loaders of all tasks
+_device_images: dict[tuple[int, torch.device], tuple[Images, torch.ByteTensor]] = {}
+
+
+def get_device_images(images: Images, device: torch.device) -> torch.ByteTensor:
+    """
+    Args:
+        images (Images): images shared by datasets, shape [N, C, H, W]
+        device (torch.device): device to copy the images to
+    Returns:
+        torch.ByteTensor: the cached copy of the images on the device, shape [N, C, H, W]
+    """
+    key = (id(images), device)
+
+    # the cached images are kept alive with the copy, so that the id is not reused
+    if key not in _device_images or _device_images[key][0] is not images:
+        _device_images[key] = (images, torch.from_numpy(images).to(device))
+    return _device_images[key][1]
+
+
+class Cifar100GPULoader:
+    """
+    DataLoader-like iterator of a Cifar100Dataset, whose images and labels are on the GPU.
+
+    Batches are sliced from the GPU copy with a (shuffled) index, so there is no per-batch host-to-device copy and no
+    DataLoader worker. If the dataset selects rows of shared images, the shared images are copied to the GPU once and
+    indexed there, so the tasks of a split share a single copy. For distributed training, each process iterates its own
+    shard of the data, as DistributedSampler. With drop_last, all batches have the same shape, which keeps CUDA graphs
+    captured by torch.compile reusable.
+    """
+
+    def __init__(
+        self,
+        dataset: Cifar100Dataset,
+        batch_size: int,
+        shuffle: bool,
+        device: torch.device,
+        rank: int = 0,
+        world_size: int = 1,
+        seed: int = 0,
+        drop_last: bool = False,
+    ) -> None:
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.device = device
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+
+        # [N_shared, C, H, W], uint8
+        if dataset.indices is None:
+            self.images = torch.from_numpy(dataset.images).to(device)
+        else:
+            self.images = get_device_images(dataset.images, device)
+        # [N_rows], rows of the dataset in the images
+        self.rows = torch.arange(dataset.num_rows, device=device) if dataset.indices is None else torch.from_numpy(
+            dataset.indices).to(device=device, dtype=torch.long)
+        # [N_appended, C, H, W], uint8
+        self.appended_images: Optional[torch.ByteTensor] = None if dataset.appended_images is None else torch.from_numpy(
+            dataset.appended_images).to(device)
+        # [N_rows + N_appended]
+        self.labels = torch.from_numpy(dataset.labels).to(device)
+
+        # same as DistributedSampler, pad the data to make it evenly divisible by world_size
+        self.num_samples = math.ceil(len(self.labels) / world_size)
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def __len__(self) -> int:
+        if self.drop_last:
+            return self.num_samples // self.batch_size
+        return math.ceil(self.num_samples / self.batch_size)
+
+    def get_images(self, batch_indices: torch.LongTensor) -> torch.ByteTensor:
+        """
+        Args:
+            batch_indices (torch.LongTensor): indices of the data in the dataset, shape [B]
+        Returns:
+            torch.ByteTensor: images of the data, shape [B, C, H, W]
+        """
+        num_rows = len(self.rows)
+        if self.appended_images is None:
+            return self.images[self.rows[batch_indices]]
+
+        # Note: gather from both the shared images and the appended images, and select per image, so the shape is static
+        is_appended = (batch_indices >= num_rows).view(-1, 1, 1, 1)
+        return torch.where(
+            is_appended,
+            self.appended_images[(batch_indices - num_rows).clamp(min=0)],
+            self.images[self.rows[batch_indices.clamp(max=num_rows - 1)]]
+        )
+
+    def __iter__(self):
+        num_data = len(self.labels)
+
+        # Note: all processes use the same permutation, so the shards do not overlap
+        if self.shuffle:
+            generator = torch.Generator().manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(num_data, generator=generator)
+        else:
+            indices = torch.arange(num_data)
 
-        # data augmentation
-        image = self.augment(image)
+        padding_size = self.num_samples * self.world_size - num_data
+        if padding_size > 0:
+            indices = torch.cat((indices, indices[:padding_size]))
 
-        return image, self.labels[index]
+        indices = indices[self.rank::self.world_size].to(self.device)
 
-    def augment(self, image: torch.FloatTensor) -> torch.FloatTensor:
-        return image if self.transforms is None else self.transforms(image)
+        for i in range(0, len(self) * self.batch_size, self.batch_size):
+            batch_indices = indices[i: i + self.batch_size]
+            yield self.get_images(batch_indices), self.labels[batch_indices]
 
 
 if __name__ == "__main__":
@@ -228,17 +459,18 @@ if __name__ == "__main__":
     camel_image, camel_label = cls_data_getter("camel", 10)
     print(f"{camel_label=}")
     print(f"{camel_image.shape=}")
-    camel_image_tensor = torch.from_numpy(camel_image[:16]).permute(0, 3, 1, 2)
+    camel_image_tensor = torch.from_numpy(camel_image[:16])
     draw_image(camel_image_tensor, "./get-class-data-example.png")
 
     # get the data of a task
     task = get_cifar100_tasks(cls_names, 10, False)[0]
-    task_image, task_label = get_cifar100_task_data(
+    images, task_label, task_indices = get_cifar100_task_data(
         "train", task, range(len(task)))
+    task_image = images[task_indices]
 
     print(f"{task=}")
     print(f"{task_label=}")
     print(f"{task_image.shape=}")
-    task_image_tensor = torch.from_numpy(task_image[:16]).permute(0, 3, 1, 2)
+    task_image_tensor = torch.from_numpy(task_image[:16])
     draw_image(task_image_tensor,
                "./get-task-data-example.png")
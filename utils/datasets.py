@@ -9,7 +9,6 @@ import numpy as np
 
 # Torch Library
 import torch.nn as nn
-import torchvision.transforms as transforms
 from torch.utils.data import Dataset, DataLoader
 
 # My Library
@@ -127,8 +126,7 @@ class CLDatasetGetter():
         task_num: int = 10,
         fixed_task: bool = False,
         given_tasks: Optional[list[Task]] = None,
-        transform: Optional[tuple[transforms.Compose,
-                                  transforms.Compose]] = (None, None)
+        transform: Optional[tuple[nn.Module, nn.Module]] = (None, None)
     ) -> None:
         # sourcery skip: assign-if-exp
 
@@ -178,10 +176,11 @@ class CLDatasetGetter():
         current_task_cls_ids = [self.cls_id_mapper[cls_name]
                                 for cls_name in current_task]
 
-        task_images_train, task_labels_train = self.train_task_data_getter(
+        # Note: images are shared by all tasks, datasets of a task only hold the row indices of the task
+        images_train, task_labels_train, task_indices_train = self.train_task_data_getter(
             current_task, current_task_cls_ids)
 
-        task_images_test, task_labels_test = self.test_task_data_getter(
+        images_test, task_labels_test, task_indices_test = self.test_task_data_getter(
             current_task, current_task_cls_ids)
 
         # get torch.utils.data.Dataset
@@ -191,9 +190,9 @@ class CLDatasetGetter():
             self.train_transform, self.test_transform = dataset.get_transforms()
 
         train_dataset = dataset(
-            task_images_train, task_labels_train, self.train_transform)
+            images_train, task_labels_train, self.train_transform, task_indices_train)
         test_dataset = dataset(
-            task_images_test, task_labels_test, self.test_transform)
+            images_test, task_labels_test, self.test_transform, task_indices_test)
 
         self.task_id += 1
 
@@ -212,8 +211,8 @@ if __name__ == "__main__":
         train_loader = DataLoader(train_dataset, batch_size=32, shuffle=True)
         test_loader = DataLoader(test_dataset, batch_size=32, shuffle=False)
 
-        draw_image(torch.from_numpy(train_dataset.images[:16]).permute(
-            0, 3, 1, 2), "./dataset.png")
+        draw_image(torch.stack(
+            [train_dataset[i][0] for i in range(16)]), "./dataset.png")
 
         print(f"{task_id=}, {cls_names=}")
         for image, label in train_loader: